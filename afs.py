@@ -1,22 +1,46 @@
 #!/usr/bin/env python3
-from struct import unpack
+from struct import unpack, unpack_from, iter_unpack
+from concurrent.futures import ThreadPoolExecutor
+import mmap
 import sys
 import os
 
 def readcstr (f):
     #extract null terminated string
-    chars = bytes ()
+    #scanning whatever is already buffered rather than a byte at a time
+    chars = bytearray ()
     while True:
-        c = f.read (1)
-        chars += c
-        if c == b'\x00':
+        buf = f.peek ()
+        if not buf:
             break
+        pos = buf.find (b'\x00')
+        if pos >= 0:
+            chars += f.read (pos + 1)
+            break
+        chars += f.read (len (buf))
     
     #skip alignment padding
     if len (chars)%2 != 0:
         f.read (1)
 
-    return chars.decode ('ascii').replace ('\0', '')
+    return chars.rstrip (b'\x00').decode ('ascii')
+
+def copyfile (out, f, mm, offset, size):
+    #Let the kernel copy straight between the files where it can
+    try:
+        while size > 0:
+            sent = os.sendfile (out.fileno (), f.fileno (), offset, size)
+            if sent == 0:
+                break
+            offset += sent
+            size -= sent
+    except (AttributeError, OSError):
+        #No sendfile here, so copy whatever is left out of the mapping
+        out.write (mm[offset : offset + size])
+
+def extract (path, f, mm, offset, size):
+    with open (path, 'wb') as out:
+        copyfile (out, f, mm, offset, size)
 
 def main (manifest, file):
     names = []
@@ -50,25 +74,35 @@ def main (manifest, file):
 
     MAGIC_KEY = 'AFS'
     with open (file, 'rb') as f:
+        #Check the magic before mapping, empty files can't be mapped
         magic = f.read (4).decode ('ascii').replace ('\0', '')
         if magic != MAGIC_KEY:
             print (f'magic {magic} != {MAGIC_KEY}')
             return
         
-        count = unpack ('<I', f.read (4))[0]
+        with mmap.mmap (f.fileno (), 0, access=mmap.ACCESS_READ) as mm:
+            count = unpack_from ('<I', mm, 4)[0]
+            if len (names) < count:
+                print (f'names {len (names)} < entries {count}')
+                return
         
-        entries = []
-        for i in range (count):
-            entry = {}
-            entry['name'] = names[i]
-            entry['offset'], entry['size'] = unpack ('<II', f.read (8))
-            entries.append (entry)
-
-        data = f.tell ()
-        for entry in entries:
-            with open (os.path.join (output, entry['name']), 'wb') as out:
-                f.seek (entry['offset'])
-                out.write (f.read (entry['size']))
+            #Entry table is an offset/size pair per file
+            #Names can repeat, in which case the last entry wins
+            table = iter_unpack ('<II', mm[8 : 8 + 8*count])
+            entries = {
+                os.path.join (output, name): entry
+                for name, entry in zip (names, table)
+            }
+            
+            #Copies never move the archive's file position, and every
+            #path is now written once, so they can all run in parallel
+            with ThreadPoolExecutor (max_workers=os.cpu_count ()) as pool:
+                jobs = [
+                    pool.submit (extract, path, f, mm, offset, size)
+                    for path, (offset, size) in entries.items ()
+                ]
+                for job in jobs:
+                    job.result ()
             
 if __name__ == '__main__':
     main (sys.argv[1], sys.argv[2])
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 from struct import unpack, pack
+from functools import lru_cache
+import numpy as np
 import png
 import sys
 import os
@@ -8,221 +10,222 @@ def verify (cond, msg):
     if not cond:
         raise Exception (msg)
 
-def pvr_decode (data, total, px, fmt, width, height):
-    #Some PVR constants
-    CODEBOOK_SIZE = 2048
-    MAX_WIDTH = 0x80000
-    MAX_HEIGHT = 0x80000
-    
-    #Image must be one of these
-    ARGB1555 = 0x0
-    RGB565   = 0x1
-    ARGB4444 = 0x2
-    YUV422   = 0x3
-    BUMP     = 0x4
-    PAL_4BPP = 0x5
-    PAL_8BPP = 0x6
-    
-    #And one of these
-    SQUARE_TWIDDLED            = 0x1
-    SQUARE_TWIDDLED_MIPMAP     = 0x2
-    VQ                         = 0x3
-    VQ_MIPMAP                  = 0x4
-    CLUT_TWIDDLED_8BIT         = 0x5
-    CLUT_TWIDDLED_4BIT         = 0x6
-    DIRECT_TWIDDLED_8BIT       = 0x7
-    DIRECT_TWIDDLED_4BIT       = 0x8
-    RECTANGLE                  = 0x9
-    RECTANGULAR_STRIDE         = 0xB
-    RECTANGULAR_TWIDDLED	   = 0xD
-    SMALL_VQ                   = 0x10
-    SMALL_VQ_MIPMAP            = 0x11
-    SQUARE_TWIDDLED_MIPMAP_ALT = 0x12
-    
-    #For printing the above
-    TYPES = [
-        'ARGB1555',
-        'RGB565',
-        'ARGB4444',
-        'YUV422',
-        'BUMP',
-        '4BPP',
-        '8BPP'
-    ]
-    FMTS = [
-        'UNK0',
-        'SQUARE TWIDDLED',
-        'SQUARE TWIDDLED MIPMAP',
-        'VQ',
-        'VQ MIPMAP',
-        'CLUT TWIDDLED 8BIT',
-        'CLUT TWIDDLED 4BIT',
-        'DIRECT TWIDDLED 8BIT',
-        'DIRECT TWIDDLED 4BIT',
-        'RECTANGLE',
-        'UNK1',
-        'RECTANGULAR STRIDE',
-        'UNK2',
-        'RECTANGULAR TWIDDLED',
-        'UNK3',
-        'UNK4',
-        'SMALL VQ',
-        'SMALL VQ MIPMAP',
-        'SQUARE TWIDDLED MIPMAP ALT'
-    ]
+#Some PVR constants
+CODEBOOK_SIZE = 2048
+MAX_WIDTH = 0x80000
+MAX_HEIGHT = 0x80000
+
+#Image must be one of these
+ARGB1555 = 0x0
+RGB565   = 0x1
+ARGB4444 = 0x2
+YUV422   = 0x3
+BUMP     = 0x4
+PAL_4BPP = 0x5
+PAL_8BPP = 0x6
+
+#And one of these
+SQUARE_TWIDDLED            = 0x1
+SQUARE_TWIDDLED_MIPMAP     = 0x2
+VQ                         = 0x3
+VQ_MIPMAP                  = 0x4
+CLUT_TWIDDLED_8BIT         = 0x5
+CLUT_TWIDDLED_4BIT         = 0x6
+DIRECT_TWIDDLED_8BIT       = 0x7
+DIRECT_TWIDDLED_4BIT       = 0x8
+RECTANGLE                  = 0x9
+RECTANGULAR_STRIDE         = 0xB
+RECTANGULAR_TWIDDLED	   = 0xD
+SMALL_VQ                   = 0x10
+SMALL_VQ_MIPMAP            = 0x11
+SQUARE_TWIDDLED_MIPMAP_ALT = 0x12
+
+#For printing the above
+TYPES = [
+    'ARGB1555',
+    'RGB565',
+    'ARGB4444',
+    'YUV422',
+    'BUMP',
+    '4BPP',
+    '8BPP'
+]
+FMTS = [
+    'UNK0',
+    'SQUARE TWIDDLED',
+    'SQUARE TWIDDLED MIPMAP',
+    'VQ',
+    'VQ MIPMAP',
+    'CLUT TWIDDLED 8BIT',
+    'CLUT TWIDDLED 4BIT',
+    'DIRECT TWIDDLED 8BIT',
+    'DIRECT TWIDDLED 4BIT',
+    'RECTANGLE',
+    'UNK1',
+    'RECTANGULAR STRIDE',
+    'UNK2',
+    'RECTANGULAR TWIDDLED',
+    'UNK3',
+    'UNK4',
+    'SMALL VQ',
+    'SMALL VQ MIPMAP',
+    'SQUARE TWIDDLED MIPMAP ALT'
+]
+
+#This is my favourite black magic spell!
+#Interleaves x and y to produce a morton code
+#This trivialises decoding PVR images
+def morton (x, y):
+    x = (x|(x<<8))&0x00ff00ff
+    y = (y|(y<<8))&0x00ff00ff
+    x = (x|(x<<4))&0x0f0f0f0f
+    y = (y|(y<<4))&0x0f0f0f0f
+    x = (x|(x<<2))&0x33333333
+    y = (y|(y<<2))&0x33333333
+    x = (x|(x<<1))&0x55555555	
+    y = (y|(y<<1))&0x55555555
+    return x|(y<<1)
+
+#morton () works just as well on arrays, so the codes for a whole
+#image can be built at once and used to gather every pixel
+#Textures tend to share a handful of sizes, so keep recent tables
+@lru_cache (maxsize=16)
+def morton_table (width, height):
+    xs = np.arange (width, dtype=np.uint32)
+    ys = np.arange (height, dtype=np.uint32)
+    table = morton (xs[None, :], ys[:, None])
+    table.flags.writeable = False
+    return table
+
+#Colour decoders...
+#These work on whole arrays of 16 bit colours at once, writing
+#each channel straight into an interleaved uint8 buffer
+#Channels are widened to 8 bits by replicating their top bits
+#into the gap, which rounds correctly without any division
+def unpack1555 (colour):
+    pix = np.empty (colour.shape + (4,), dtype=np.uint8)
+    r = (colour>>10)&31
+    g = (colour>> 5)&31
+    b = (colour    )&31
+    pix[..., 0] = (r<<3)|(r>>2)
+    pix[..., 1] = (g<<3)|(g>>2)
+    pix[..., 2] = (b<<3)|(b>>2)
+    pix[..., 3] = 255*((colour>>15)&1)
+    return pix
+
+def unpack4444 (colour):
+    pix = np.empty (colour.shape + (4,), dtype=np.uint8)
+    a = (colour>>12)&15
+    r = (colour>> 8)&15
+    g = (colour>> 4)&15
+    b = (colour    )&15
+    pix[..., 0] = (r<<4)|r
+    pix[..., 1] = (g<<4)|g
+    pix[..., 2] = (b<<4)|b
+    pix[..., 3] = (a<<4)|a
+    return pix
+
+def unpack565 (colour):
+    pix = np.empty (colour.shape + (3,), dtype=np.uint8)
+    r = (colour>>11)&31
+    g = (colour>> 5)&63
+    b = (colour    )&31
+    pix[..., 0] = (r<<3)|(r>>2)
+    pix[..., 1] = (g<<2)|(g>>4)
+    pix[..., 2] = (b<<3)|(b>>2)
+    return pix
+
+#Format decoders...
+#GOTCHA: PVR stores mipmaps from smallest to largest!
+def vq_decode (raw, decoder, width, height):
+    #Extract the codebook
+    book = np.frombuffer (raw[:CODEBOOK_SIZE], dtype='<u2')
+
+    #Skip to the largest mipmap
+    #NB: This also avoids another gotcha:
+    #Between the codebook and the mipmap data is a padding byte
+    #Since we only want the largest though, it doesn't affect us
+    size = len (raw)
+    base = width*height//4
+    lut = raw[size - base : size]
+
+    #The codebook is a 2x2 block of 16 bit pixels
+    #This effectively halves the image dimensions
+    #Each index of the data refers to a codebook entry
+    #Entries are stored column by column, so flip them into rows
+    #There are only 256 entries, so unpack them once up front
+    blocks = book.reshape (-1, 2, 2).transpose (0, 2, 1)
+    blocks = decoder (blocks)
+    #NB: VQ indices are twiddled with x and y swapped
+    lut = np.frombuffer (lut, dtype=np.uint8)
+    tiles = blocks[lut[morton_table (height//2, width//2).T]]
+
+    #Interleave the block rows with the tile rows to lay out the image
+    return tiles.transpose (0, 2, 1, 3, 4).reshape (height, -1)
+
+def morton_decode (raw, decoder, width, height):
+    #Skip to largest mipmap
+    size = len (raw)
+    base = width*height*2
+    mip = raw[size - base : size]
+
+    #Expand image with dummy data if non square
+    #this is needed or else morton codes will go out of bounds
+    #on rectangular images - even though it is benign
+    data = np.frombuffer (mip, dtype='<u2')
+    if width != height:
+        padded = np.zeros (max (width, height)**2, dtype=np.uint16)
+        padded[:width*height] = data
+        data = padded
 
+    colours = data[morton_table (width, height)]
+    return decoder (colours).reshape (height, -1)
+
+def linear_decode (raw, decoder, width, height):
+    #Skip to largest mipmap
+    size = len (raw)
+    base = width*height*2
+    mip = raw[size - base : size]
+
+    colours = np.frombuffer (mip, dtype='<u2').reshape (height, width)
+    return decoder (colours).reshape (height, -1)
+
+#From observation:
+#All textures 16 bit
+#All textures are either VQ'd or morton coded (twiddled)
+#So let's just save time and only implement those
+def layout_decoder (fmt):
+    if SQUARE_TWIDDLED == fmt or SQUARE_TWIDDLED_MIPMAP == fmt or RECTANGULAR_TWIDDLED == fmt:
+        return morton_decode
+    elif VQ == fmt or VQ_MIPMAP == fmt:
+        return vq_decode
+    else:
+        return linear_decode
+
+#Maps (px, fmt) to its format decoder, colour decoder and png mode
+DISPATCH = {
+    (px, fmt): (layout_decoder (fmt), decoder, mode)
+    for px, decoder, mode in (
+        (ARGB1555, unpack1555, 'RGBA'),
+        (ARGB4444, unpack4444, 'RGBA'),
+        (RGB565,   unpack565,  'RGB')
+    )
+    for fmt in range (len (FMTS))
+}
+
+def pvr_decode (data, total, px, fmt, width, height):
     #Print info and verify
     print (f'    Type: {TYPES[px]} {FMTS[fmt]}, Size: {width}x{height}')
     verify (width <= MAX_WIDTH, f'width is {width}; must be < {MAX_WIDTH}')
     verify (height <= MAX_HEIGHT, f'height is {height}; must be < {MAX_HEIGHT}')
     
-    #This is my favourite black magic spell!
-    #Interleaves x and y to produce a morton code
-    #This trivialises decoding PVR images
-    def morton (x, y):
-        x = (x|(x<<8))&0x00ff00ff
-        y = (y|(y<<8))&0x00ff00ff
-        x = (x|(x<<4))&0x0f0f0f0f
-        y = (y|(y<<4))&0x0f0f0f0f
-        x = (x|(x<<2))&0x33333333
-        y = (y|(y<<2))&0x33333333
-        x = (x|(x<<1))&0x55555555	
-        y = (y|(y<<1))&0x55555555
-        return x|(y<<1)
-    
-    #Colour decoders...
-    def unpack1555 (colour):
-        a = int (255*((colour>>15)&31))
-        r = int (255*((colour>>10)&31)/31.0)
-        g = int (255*((colour>> 5)&31)/31.0)
-        b = int (255*((colour    )&31)/31.0)
-        return [r, g, b, a]
-        
-    def unpack4444 (colour):
-        a = int (255*((colour>>12)&15)/15.0)
-        r = int (255*((colour>> 8)&15)/15.0)
-        g = int (255*((colour>> 4)&15)/15.0)
-        b = int (255*((colour    )&15)/15.0)
-        return [r, g, b, a]
-    
-    def unpack565 (colour):
-        r = int (255*((colour>>11)&31)/31.0)
-        g = int (255*((colour>> 5)&63)/63.0)
-        b = int (255*((colour    )&31)/31.0)
-        return [r, g, b]
-    
-    #Format decoders...
-    #GOTCHA: PVR stores mipmaps from smallest to largest!
-    def vq_decode (raw, decoder):
-        pix = []
-        
-        #Extract the codebook
-        tmp = raw
-        book = unpack (f'<1024H', tmp[:CODEBOOK_SIZE])
-        
-        #Skip to the largest mipmap
-        #NB: This also avoids another gotcha:
-        #Between the codebook and the mipmap data is a padding byte
-        #Since we only want the largest though, it doesn't affect us
-        size = len (raw)
-        base = width*height//4
-        lut = raw[size - base : size]
-        
-        #The codebook is a 2x2 block of 16 bit pixels
-        #This effectively halves the image dimensions
-        #Each index of the data refers to a codebook entry
-        for i in range (height//2):
-            row0 = []
-            row1 = []
-            for j in range (width//2):
-                entry = 4*lut[morton (i, j)]
-                row0.extend (decoder (book[entry + 0]))
-                row1.extend (decoder (book[entry + 1]))
-                row0.extend (decoder (book[entry + 2]))
-                row1.extend (decoder (book[entry + 3]))
-            pix.append (row0)
-            pix.append (row1)
-            #pix.insert (0, row0)
-            #pix.insert (0, row1)
-        return pix
-    
-    def morton_decode (raw, decoder):
-        pix = []
-        
-        #Skip to largest mipmap
-        size = len (raw)
-        base = width*height*2
-        mip = raw[size - base : size]
-        
-        #Expand image with dummy data if non square
-        #this is needed or else morton codes will go out of bounds
-        #on rectangular images - even though it is benign
-        data = list (unpack (f'<{width*height}H', mip))
-        if width != height:
-            if width < height:
-                squared = height*height
-            else:
-                squared = width*width
-            data += bytes (squared - len (data))
-
-        for i in range (height):
-            row = []
-            for j in range (width):
-                colour = data[morton (j, i)]
-                row.extend (decoder (colour))
-            #pix.insert (0, row)
-            pix.append (row)
-        return pix
-    
-    def linear_decode (raw, decoder):
-        pix = []
-        
-        #Skip to largest mipmap
-        size = len (raw)
-        base = width*height*2
-        mip = raw[size - base : size]
-        
-        data = unpack (f'<{width*height}H', mip)
-        for i in range (height):
-            row = []
-            for j in range (width):
-                row.extend (decoder (data[i*width + j]))
-            #pix.insert (0, row)
-            pix.append (row)
-        return pix
-
-    #From observation:
-    #All textures 16 bit
-    #All textures are either VQ'd or morton coded (twiddled)
-    #So let's just save time and only implement those
-    if ARGB1555 == px:
-        if SQUARE_TWIDDLED == fmt or SQUARE_TWIDDLED_MIPMAP == fmt or RECTANGULAR_TWIDDLED == fmt:
-            return morton_decode (data, unpack1555), 'RGBA'
-        elif VQ == fmt or VQ_MIPMAP == fmt:
-            return vq_decode (data, unpack1555), 'RGBA'
-        else:
-            return linear_decode (data, unpack1555), 'RGBA'
-    elif ARGB4444 == px:
-        if SQUARE_TWIDDLED == fmt or SQUARE_TWIDDLED_MIPMAP == fmt or RECTANGULAR_TWIDDLED == fmt:
-            return morton_decode (data, unpack4444), 'RGBA'
-        elif VQ == fmt or VQ_MIPMAP == fmt:
-            return vq_decode (data, unpack4444), 'RGBA'
-        else:
-            return linear_decode (data, unpack4444), 'RGBA'
-    elif RGB565 == px:
-        if SQUARE_TWIDDLED == fmt or SQUARE_TWIDDLED_MIPMAP == fmt or RECTANGULAR_TWIDDLED == fmt:
-            return morton_decode (data, unpack565), 'RGB'
-        elif VQ == fmt or VQ_MIPMAP == fmt:
-            return vq_decode (data, unpack565), 'RGB'
-        else:
-            return linear_decode (data, unpack565), 'RGB'
+    fn, decoder, mode = DISPATCH.get ((px, fmt), (None, None, 'ERROR'))
+    if fn is not None:
+        return fn (data, decoder, width, height), mode
     
     #Oh, well...
     return 'Unsupported encoding', 'ERROR'
 
-    pixels, status = pvr_decode (data[20:], len (data) - 20, px, fmt, width, height)
-    return pixels, status
-
 def main (file):
     base = os.path.splitext (file)[0]
     with open (file, 'rb') as f:
@@ -239,7 +242,14 @@ def main (file):
         print (f'converting {file}...')
 
         pixels, status = pvr_decode (f.read (), size, px, fmt, width, height)
-        png.from_array (pixels, status).save (base + '.png')
+        if 'ERROR' == status:
+            print (f'{file}: {pixels}')
+            return
+
+    #Hand rows to the writer one at a time as bytes
+    writer = png.Writer (width, height, greyscale=False, alpha=('RGBA' == status))
+    with open (base + '.png', 'wb') as out:
+        writer.write (out, (row.tobytes () for row in pixels))
 
 if __name__ == '__main__':
     main (sys.argv[1])